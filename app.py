@@ -1,36 +1,216 @@
 # --- Imports ---
 import gradio as gr
 from rag_pipeline import RAGPipeline
+from query_assistant import use_onnx_embeddings
 import os
+import atexit
+import functools
+import hashlib
+import threading
+import numpy as np
+import torch
 from config import *  # Import all config variables for future use
 
-# --- Initialize RAG Pipeline ---
-rag_pipeline = RAGPipeline()
+# --- Lazy RAG Pipeline ---
+@functools.lru_cache(maxsize=1)
+def _pipeline():
+    """
+    Creates the RAG pipeline on first request, so importing this module does not load any models.
+    The semantic cache is restored (and its save at exit registered) at the same time.
+    """
+    pipeline = RAGPipeline()
+    load_semantic_cache()
+    atexit.register(save_semantic_cache)
+    return pipeline
+
+# Embedding is compute-bound on CPU, so extra workers there only add context switches
+concurrency_limit = GRADIO_CONCURRENCY_LIMIT if torch.cuda.is_available() else 1
+# All model-calling listeners share one concurrency group, so the limit applies across them
+MODEL_CONCURRENCY_ID = "model"
+
+
+# --- Semantic Query Cache ---
+# Embeddings of recently answered questions (one unit-norm row each) and their (answer, sources) outputs
+_cache_vecs = None
+_cache_answers = []
+_cache_lock = threading.Lock()
+_cache_fingerprint = None  # Fingerprint of the index/models/prompt the cached answers belong to
+
+
+def semantic_cache_fingerprint():
+    """
+    Identifies the index, models and prompt the cached answers were produced with.
+    Returns:
+        str: Hex digest that changes whenever any of them changes.
+    """
+    index_file = os.path.join(FAISS_INDEX_PATH, "index.faiss")
+    index_stamp = ""
+    if os.path.exists(index_file):
+        stat = os.stat(index_file)
+        index_stamp = f"{stat.st_mtime_ns}:{stat.st_size}"
+    # INT8 ONNX and torch embedders produce different query vectors, so the resolved backend counts too
+    embedding_backend = "onnx" if use_onnx_embeddings() else "torch"
+    parts = [
+        index_stamp, EMBEDDING_MODEL_NAME, embedding_backend, LLM_BACKEND, LLM_MODEL_NAME,
+        str(LLM_QUANTIZATION), repr(LLM_STOP_SEQUENCES), PROMPT_TEMPLATE
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def load_semantic_cache():
+    """
+    Restores the semantic cache saved by a previous run, if present and still valid
+    for the current index, models and prompt.
+    """
+    global _cache_vecs, _cache_answers, _cache_fingerprint
+    _cache_fingerprint = semantic_cache_fingerprint()
+    if not os.path.exists(SEMANTIC_CACHE_PATH):
+        return
+    try:
+        with np.load(SEMANTIC_CACHE_PATH) as data:
+            if "fingerprint" not in data.files or str(data["fingerprint"]) != _cache_fingerprint:
+                print(f"Discarding stale semantic cache at {SEMANTIC_CACHE_PATH} (index, model or prompt changed).")
+                return
+            _cache_vecs = data["vecs"].astype(np.float32)
+            _cache_answers = [tuple(pair) for pair in data["answers"].tolist()]
+        print(f"Loaded {len(_cache_answers)} cached answers from {SEMANTIC_CACHE_PATH}.")
+    except Exception as e:
+        print(f"Error loading semantic cache: {e}")
+        _cache_vecs, _cache_answers = None, []
+
+
+def save_semantic_cache():
+    """
+    Persists the semantic cache to disk (registered to run at interpreter exit).
+    """
+    with _cache_lock:
+        if not _cache_answers:
+            return
+        try:
+            np.savez(
+                SEMANTIC_CACHE_PATH,
+                vecs=_cache_vecs,
+                answers=np.array(_cache_answers, dtype=str),
+                fingerprint=np.array(_cache_fingerprint)
+            )
+            print(f"Saved {len(_cache_answers)} cached answers to {SEMANTIC_CACHE_PATH}.")
+        except Exception as e:
+            print(f"Error saving semantic cache: {e}")
+
+
+def lookup_semantic_cache(query_vec):
+    """
+    Returns the cached (answer, sources) of the most similar previous question,
+    or None if none is similar enough.
+    """
+    with _cache_lock:
+        if _cache_vecs is None or _cache_vecs.shape[1] != query_vec.shape[0]:
+            return None
+        scores = _cache_vecs @ query_vec  # Cosine similarity, since all vectors are unit-norm
+        best = int(scores.argmax())
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return _cache_answers[best]
+        return None
+
+
+def add_to_semantic_cache(query_vec, response):
+    """
+    Stores a question embedding and its (answer, sources) output, evicting the oldest entries.
+    """
+    global _cache_vecs, _cache_answers
+    with _cache_lock:
+        if _cache_vecs is None or _cache_vecs.shape[1] != query_vec.shape[0]:
+            _cache_vecs, _cache_answers = query_vec[None, :], [response]
+        else:
+            _cache_vecs = np.vstack([_cache_vecs, query_vec[None, :]])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+            _cache_answers = (_cache_answers + [response])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+
+
+# --- Sources Formatting ---
+def format_sources(sources):
+    """
+    Renders the retrieved source documents as Markdown for the sources panel.
+    """
+    if not sources:
+        return "_No specific sources were found in the knowledge base to answer this question, or the answer was a canned response._"
+    sources_text = "**Sources Used:**\n\n"
+    for i, doc in enumerate(sources):
+        source_file_name = os.path.basename(doc.metadata.get('source', 'N/A'))
+        sources_text += (
+            f"> **Source {i+1}:** `{source_file_name}` (Chunk ID: `{doc.metadata.get('chunk_id', 'N/A')}`)\n"
+            f"> ```\n{doc.page_content[:300]}...\n```\n\n"
+        )
+    return sources_text
 
 
 # --- Gradio Callback: Get AI Response ---
-def get_ai_response(user_query):
+def get_ai_response(user_queries):
     """
-    Handles user queries, returns assistant's answer and sources.
+    Handles a batch of user queries (Gradio batch mode), returns assistant's answers and sources.
+    Args:
+        user_queries (list): Questions collected from the Gradio queue.
+    Returns:
+        Tuple[list, list]: (answers, sources texts), aligned with user_queries.
+    """
+    answers = ["<i>Please enter a question.</i>"] * len(user_queries)
+    sources_texts = [""] * len(user_queries)
+    pending = [i for i, user_query in enumerate(user_queries) if user_query.strip()]
+    if not pending:
+        return answers, sources_texts
+    try:
+        # One embedding call for the whole batch, shared by the cache lookup and retrieval
+        query_vecs = _pipeline().embed_queries([user_queries[i] for i in pending])
+        vecs_by_index = dict(zip(pending, query_vecs))
+        misses = []
+        for i in pending:
+            cached = lookup_semantic_cache(vecs_by_index[i])
+            if cached is not None:
+                answers[i], sources_texts[i] = cached
+            else:
+                misses.append(i)
+        if misses:
+            batch_answers, batch_sources = _pipeline().query_batch(
+                [user_queries[i] for i in misses], [vecs_by_index[i] for i in misses]
+            )
+            for i, answer, sources in zip(misses, batch_answers, batch_sources):
+                answers[i], sources_texts[i] = answer, format_sources(sources)
+                # Only grounded answers are cached; refusals never reach the LLM and errors should be retried
+                if sources:
+                    add_to_semantic_cache(vecs_by_index[i], (answers[i], sources_texts[i]))
+        return answers, sources_texts
+    except Exception as e:
+        error_text = (
+            f"<span style='color:red'><b>An error occurred during query:</b> {e}<br>"
+            "Please ensure your backend and model are available.</span>")
+        return [error_text] * len(user_queries), [""] * len(user_queries)
+
+
+# --- Gradio Callback: Stream AI Response ---
+def stream_ai_response(user_query):
+    """
+    Handles a single user query, streaming the assistant's answer as it is generated
+    and showing the sources once it is complete.
     """
     if not user_query.strip():
-        return ("<i>Please enter a question.</i>", "")
+        yield ("<i>Please enter a question.</i>", "")
+        return
     try:
-        answer, sources = rag_pipeline.query(user_query)
-        sources_text = ""
+        # Cached in the pipeline, so stream_query's retrieval reuses this embedding
+        query_vec = np.asarray(_pipeline().embed_query(user_query), dtype=np.float32)
+        cached = lookup_semantic_cache(query_vec)
+        if cached is not None:
+            yield cached
+            return
+        answer, sources = "", []
+        for answer, sources in _pipeline().stream_query(user_query):
+            yield answer, ""
+        sources_text = format_sources(sources)
+        # Only grounded answers are cached; refusals never reach the LLM and errors should be retried
         if sources:
-            sources_text = "**Sources Used:**\n\n"
-            for i, doc in enumerate(sources):
-                source_file_name = os.path.basename(doc.metadata.get('source', 'N/A'))
-                sources_text += (
-                    f"> **Source {i+1}:** `{source_file_name}` (Chunk ID: `{doc.metadata.get('chunk_id', 'N/A')}`)\n"
-                    f"> ```\n{doc.page_content[:300]}...\n```\n\n"
-                )
-        else:
-            sources_text = "_No specific sources were found in the knowledge base to answer this question, or the answer was a canned response._"
-        return answer, sources_text
+            add_to_semantic_cache(query_vec, (answer, sources_text))
+        yield answer, sources_text
     except Exception as e:
-        return (
+        yield (
             f"<span style='color:red'><b>An error occurred during query:</b> {e}<br>"
             "Please ensure your backend and model are available.</span>", "")
 
@@ -65,6 +245,8 @@ with gr.Blocks(title="Intelligent Knowledge Base Assistant", theme="soft") as de
             clear_btn = gr.Button("Clear", scale=0)
     answer_output = gr.Markdown(label="Assistant's Answer:")
     sources_output = gr.Markdown(label="Sources Used:")
+    # Hidden trigger that exposes the batched handler as an API endpoint
+    batch_btn = gr.Button(visible=False)
     clear_btn.click(
         fn=clear_fields,
         inputs=[],
@@ -72,15 +254,29 @@ with gr.Blocks(title="Intelligent Knowledge Base Assistant", theme="soft") as de
         queue=False
     )
     submit_btn.click(
-        fn=get_ai_response,
+        fn=stream_ai_response,
         inputs=query_input,
         outputs=[answer_output, sources_output],
-        api_name="ask_question"
+        api_name="ask_question",
+        concurrency_limit=concurrency_limit,
+        concurrency_id=MODEL_CONCURRENCY_ID
     )
     query_input.submit(
+        fn=stream_ai_response,
+        inputs=query_input,
+        outputs=[answer_output, sources_output],
+        concurrency_limit=concurrency_limit,
+        concurrency_id=MODEL_CONCURRENCY_ID
+    )
+    batch_btn.click(
         fn=get_ai_response,
         inputs=query_input,
-        outputs=[answer_output, sources_output]
+        outputs=[answer_output, sources_output],
+        api_name="ask_questions",
+        concurrency_limit=concurrency_limit,
+        concurrency_id=MODEL_CONCURRENCY_ID,
+        batch=True,
+        max_batch_size=LLM_BATCH_SIZE
     )
     gr.Markdown("---")
     gr.Markdown(
@@ -89,4 +285,7 @@ with gr.Blocks(title="Intelligent Knowledge Base Assistant", theme="soft") as de
     )
 
 # --- Launch Gradio App ---
-demo.launch(show_error=True, share=False)
\ No newline at end of file
+if __name__ == "__main__":
+    # Load models before opening the port so the first request does not pay for it
+    _pipeline()
+    demo.queue(default_concurrency_limit=concurrency_limit, max_size=GRADIO_QUEUE_MAX_SIZE).launch(show_error=True, share=False)
\ No newline at end of file
@@ -12,12 +12,43 @@ EVALUATION_RESULTS_PATH = os.path.join(DATA_DIR, "evaluation_results.csv")
 
 # --- Embedding Model Configuration ---
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 64 # Texts per encode batch (chunks during ingestion, questions in batched queries)
+EMBEDDING_TORCH_COMPILE = True # Compile the torch embedder's transformer with torch.compile on GPU (one-off warmup at load)
+# "torch" (sentence-transformers), "onnx" (ONNX Runtime, INT8-quantized, CPU) or
+# "auto" (ONNX on CPU-only machines when optimum[onnxruntime] is installed, torch otherwise)
+EMBEDDING_BACKEND = "auto"
+EMBEDDING_ONNX_DIR = os.path.join(DATA_DIR, "onnx_embeddings") # Exported/quantized model cache
 
 # --- LLM Configuration (for Gradio/HuggingFace) ---
 LLM_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"  # Used in Gradio app (see app.py)
-LLM_BASE_URL = None  # Not used for HuggingFacePipeline/Gradio local model
+# "hf": in-process transformers model (below). "onnx": the same model exported to ONNX and run
+# with ONNX Runtime (CUDA execution provider with IOBinding when available), cached in LLM_ONNX_DIR.
+# "vllm": an OpenAI-compatible vLLM server at
+# LLM_BASE_URL, which continuously batches concurrent requests on the GPU, e.g.
+#   vllm serve TinyLlama/TinyLlama-1.1B-Chat-v1.0 --dtype bfloat16 --max-num-seqs 64 --gpu-memory-utilization 0.9 --enable-prefix-caching
+LLM_BACKEND = "hf"
+LLM_BASE_URL = "http://localhost:8000/v1"  # Only used with LLM_BACKEND = "vllm"
+LLM_ONNX_DIR = os.path.join(DATA_DIR, "onnx_llm")  # Only used with LLM_BACKEND = "onnx"
+LLM_MAX_NEW_TOKENS = 256  # Answers are a few sentences; also sizes the pre-allocated (static) KV cache
+LLM_TORCH_COMPILE = True  # Compile the LLM forward pass with torch.compile on GPU ("reduce-overhead"; adds a one-off warmup at startup)
+LLM_PREFIX_CACHE = True  # Reuse the KV cache of the fixed prompt preamble instead of re-prefilling it per query
+LLM_MAX_CACHE_LEN = 2048  # KV cache slots for prefix-cached generation (TinyLlama's context length)
+LLM_BATCH_SIZE = 16  # Prompts per padded generate call for batched queries
+# "auto" (SDPA with the static KV cache; FlashAttention-2 on CUDA when flash-attn is installed and the
+# cache is dynamic, i.e. with assisted generation), "flash_attention_2" or "sdpa"
+LLM_ATTN_IMPLEMENTATION = "auto"
+# Generation stops as soon as the model starts inventing a follow-up turn
+LLM_STOP_SEQUENCES = ["\nQuestion:", "\nQ:", "\nUser:"]
+# Speculative decoding for single-prompt generation: a draft model (must share the LLM's tokenizer)
+# or prompt-lookup drafting, which proposes n-grams copied from the prompt; a good fit for RAG answers
+# that quote the retrieved context. Either one turns off the static KV cache, torch.compile and the
+# prefix cache, which assisted generation does not support.
+LLM_ASSISTANT_MODEL_NAME = None  # e.g. a smaller model from the same family
+LLM_PROMPT_LOOKUP_TOKENS = None  # e.g. 10 to enable prompt-lookup decoding (ignored if an assistant model is set)
+LLM_QUANTIZATION = "4bit"  # "4bit" (bitsandbytes NF4), "8bit" (bitsandbytes LLM.int8), CUDA only; None for unquantized bfloat16 weights
 
 # --- Document Processing Configuration ---
+LOADER_MAX_WORKERS = 16 # Threads used to read text/markdown files during ingestion
 CHUNK_SIZE = 500  # Characters per chunk
 CHUNK_OVERLAP = 50 # Overlap between chunks to maintain context
 
@@ -26,7 +57,48 @@ CHUNK_OVERLAP = 50 # Overlap between chunks to maintain context
 # This value needs tuning based on your specific embedding model and data.
 # A common range is 0.5 to 0.8 for L2 distance with normalized embeddings.
 RELEVANCE_THRESHOLD_L2 = 0.7 # Tuned value from your testing
-TOP_K_RETRIEVAL = 3 # Number of top relevant documents to retrieve for consideration
+# The index stores L2-normalized embeddings and scores by inner product (cosine similarity):
+# same ranking as L2 on unit vectors, with no subtraction per dimension and no sqrt to threshold.
+# FAISS L2 scores are squared distances, and for unit vectors d^2 = 2 - 2*cos, so the
+# tuned L2 threshold maps to a minimum inner-product score of 1 - d^2/2.
+RELEVANCE_THRESHOLD_IP = 1 - RELEVANCE_THRESHOLD_L2 / 2
+
+# --- FAISS Index Configuration ---
+# IVF index: vectors are grouped into FAISS_NLIST Voronoi cells and queries only scan
+# the FAISS_NPROBE closest cells instead of the full vector matrix. Within a cell, vectors
+# are stored either as one int8 per dimension ("SQ8", 4x smaller than float32, near-exact
+# scores) or as FAISS_PQ_M product-quantizer codes of FAISS_PQ_NBITS bits each ("PQ").
+FAISS_ENCODING = "SQ8" # "SQ8" or "PQ"
+FAISS_NLIST = None # None -> round(sqrt(number of chunks))
+FAISS_PQ_M = 16 # Must divide the embedding dimension (384 for all-MiniLM-L6-v2)
+FAISS_PQ_NBITS = 8
+FAISS_NPROBE = 8 # Number of cells scanned per query
+# The IVF cell centroids are searched through an HNSW graph rather than brute force,
+# so routing stays cheap even with a large FAISS_NLIST.
+FAISS_HNSW_M = 32 # Graph neighbours per centroid
+FAISS_HNSW_EF_CONSTRUCTION = 40
+FAISS_HNSW_EF_SEARCH = 16
+# Corpora up to this many chunks are searched by an exact brute-force scan over a cached
+# contiguous copy of the vectors (SimSIMD kernels when installed, numpy otherwise)
+# instead of through the FAISS index. 0 disables the brute-force path.
+BRUTE_FORCE_MAX_VECTORS = 50000
+# Unquantized float32 embeddings saved next to index.faiss at ingestion, read by the brute-force scan
+# (the SQ8/PQ index itself only holds lossy codes)
+FAISS_VECTORS_FILE = "vectors.npy"
+# Top-1 retrieval first scores only this many leading dimensions, then bounds the rest
+# (Cauchy-Schwarz) to skip chunks that cannot reach the relevance threshold
+BRUTE_FORCE_PRUNE_DIMS = 64
+
+# --- Semantic Query Cache (Gradio app) ---
+# Answers to previous questions are reused when a new question's embedding is at least
+# this cosine-similar. The cache is discarded when the index, models or prompt change.
+SEMANTIC_CACHE_PATH = os.path.join(DATA_DIR, "semantic_cache.npz")
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_MAX_ENTRIES = 512
+
+# --- Gradio Server Configuration ---
+GRADIO_CONCURRENCY_LIMIT = 2  # Concurrent query workers on GPU; CPU deployments always use 1
+GRADIO_QUEUE_MAX_SIZE = 64  # Requests allowed to wait in the queue before new ones are rejected
 
 # --- LLM Prompt Template ---
 PROMPT_TEMPLATE = """You are a helpful assistant. Your task is to answer the user's question ONLY based on the provided context.
@@ -39,4 +111,10 @@ Context:
 
 Question: {question}
 
-Answer:"""
\ No newline at end of file
+Answer:"""
+
+# Template pre-split around its placeholders, so prompts are built by concatenation
+# (no per-query str.format parsing) and the fixed preamble can be KV-cached
+PROMPT_PREFIX, _rest = PROMPT_TEMPLATE.split("{context}", 1)
+PROMPT_MIDDLE, PROMPT_SUFFIX = _rest.split("{question}", 1)
+del _rest
@@ -5,7 +5,7 @@ Script for running automated and manual evaluation of the RAG pipeline using eva
 """
 
 # --- Imports ---
-import pandas as pd
+import csv
 from rag_pipeline import RAGPipeline
 import os
 import time
@@ -13,6 +13,18 @@ from config import *
 from langchain_huggingface import HuggingFaceEmbeddings  # For compatibility with new LangChain versions
 
 
+# --- Evaluation Results Columns ---
+RESULT_FIELDS = [
+    "question", "expected_answer_snippet", "is_in_kb", "assistant_answer",
+    "retrieved_source_filenames", "retrieved_chunk_contents_preview", "response_time_sec",
+    # --- Manual Assessment Columns (to be filled by you) ---
+    "manual_retrieval_relevance", # Good/Partial/Bad
+    "manual_answer_accuracy", # Correct/Partially Correct/Incorrect
+    "manual_grounding_faithfulness", # Grounded/Hallucinated/Correctly No-Info
+    "manual_overall_pass" # Yes/No
+]
+
+
 # --- Evaluation Data Loader ---
 def load_evaluation_data(file_path):
     """
@@ -20,70 +32,90 @@ def load_evaluation_data(file_path):
     Args:
         file_path (str): Path to the evaluation CSV file.
     Returns:
-        pd.DataFrame: DataFrame containing evaluation questions.
+        list: One dict per question, keyed by the CSV header.
     Raises:
         FileNotFoundError: If the file does not exist.
     """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Evaluation data file not found at: {file_path}")
-    return pd.read_csv(file_path)
+    with open(file_path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+# --- Evaluation Results Writer ---
+def save_evaluation_results(results, file_path):
+    """
+    Writes evaluation results to a CSV file.
+    Args:
+        results (list): One dict per question, as returned by run_evaluation.
+        file_path (str): Path to the output CSV file.
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
 
 
 # --- Evaluation Runner ---
-def run_evaluation(rag_pipeline: RAGPipeline, eval_df: pd.DataFrame):
+def run_evaluation(rag_pipeline: RAGPipeline, eval_rows):
     """
     Runs the RAG pipeline against the evaluation questions and collects results.
     Args:
         rag_pipeline (RAGPipeline): The RAG pipeline instance.
-        eval_df (pd.DataFrame): DataFrame of evaluation questions.
+        eval_rows (list): Evaluation questions, as returned by load_evaluation_data.
     Returns:
-        pd.DataFrame: DataFrame of evaluation results.
+        list: One result dict per question, keyed by RESULT_FIELDS.
     """
-    results = []
-    total_questions = len(eval_df)
+    questions = [row["question"] for row in eval_rows]
+    total_questions = len(questions)
     print(f"\n--- Starting Evaluation for {total_questions} Questions ---")
 
-    for idx, (_, row) in enumerate(eval_df.iterrows()):
-        question = row["question"]
-        expected_snippet = row["expected_answer_snippet"]
-        is_in_kb = row["is_in_kb"]
+    # All questions go through the pipeline as one batch (one embedding call, batched LLM generation).
+    # Retrieval and generation are timed separately: questions that miss the relevance threshold
+    # are refused without the LLM, so they are charged retrieval time only.
+    try:
+        start_time = time.time()
+        top_docs = rag_pipeline.retrieve_batch(questions)
+        retrieval_time = (time.time() - start_time) / max(total_questions, 1)
+        start_time = time.time()
+        batch_answers, batch_sources = rag_pipeline.generate_batch(questions, top_docs)
+        num_generated = sum(doc is not None for doc in top_docs)
+        generation_time = (time.time() - start_time) / max(num_generated, 1)
+        # Per-question time is amortized over the batch
+        response_times = [
+            round(retrieval_time + (generation_time if doc is not None else 0.0), 2) for doc in top_docs
+        ]
+    except Exception as e:
+        batch_answers = [f"ERROR: {e}"] * total_questions
+        batch_sources = [[] for _ in range(total_questions)]
+        response_times = [-1] * total_questions # Indicate error
+        print(f"  Error during batch query: {e}")
 
-        print(f"\n[{idx + 1}/{total_questions}] Question: {question}")
-        if pd.isna(expected_snippet) or expected_snippet == '' or expected_snippet == 'N/A':
-            print(f"  (Expected KB: {is_in_kb})")
+    results = []
+    for idx, row in enumerate(eval_rows):
+        expected_snippet = row.get("expected_answer_snippet") or ""
+        print(f"\n[{idx + 1}/{total_questions}] Question: {questions[idx]}")
+        if expected_snippet in ('', 'N/A'):
+            print(f"  (Expected KB: {row['is_in_kb']})")
         else:
-            print(f"  (Expected KB: {is_in_kb}, Snippet: {str(expected_snippet)[:50]}...)")
+            print(f"  (Expected KB: {row['is_in_kb']}, Snippet: {expected_snippet[:50]}...)")
+        print(f"  Assistant Answer: {batch_answers[idx][:100]}...")
+        print(f"  Response Time: {response_times[idx]}s")
 
-        start_time = time.time()
-        try:
-            assistant_answer, sources = rag_pipeline.query(question)
-            end_time = time.time()
-            response_time = round(end_time - start_time, 2)
-        except Exception as e:
-            assistant_answer = f"ERROR: {e}"
-            sources = []
-            response_time = -1 # Indicate error
-            print(f"  Error during query: {e}")
-
-        result = {
-            "question": question,
+        sources = batch_sources[idx]
+        results.append({
+            "question": questions[idx],
             "expected_answer_snippet": expected_snippet,
-            "is_in_kb": is_in_kb,
-            "assistant_answer": assistant_answer,
+            "is_in_kb": row["is_in_kb"],
+            "assistant_answer": batch_answers[idx],
             "retrieved_source_filenames": [os.path.basename(s.metadata.get('source', 'N/A')) for s in sources],
             "retrieved_chunk_contents_preview": [s.page_content[:200] for s in sources],
-            "response_time_sec": response_time,
-            # --- Manual Assessment Columns (to be filled by you) ---
-            "manual_retrieval_relevance": "", # Good/Partial/Bad
-            "manual_answer_accuracy": "", # Correct/Partially Correct/Incorrect
-            "manual_grounding_faithfulness": "", # Grounded/Hallucinated/Correctly No-Info
-            "manual_overall_pass": "" # Yes/No
-        }
-        results.append(result)
-        print(f"  Assistant Answer: {assistant_answer[:100]}...")
-        print(f"  Response Time: {response_time}s")
+            "response_time_sec": response_times[idx],
+            **{field: "" for field in RESULT_FIELDS if field.startswith("manual_")}
+        })
 
-    return pd.DataFrame(results)
+    return results
 
 
 # --- Main Evaluation Pipeline ---
@@ -99,12 +131,11 @@ def main():
         print("Please ensure your FAISS index exists (run ingest_data.py) and Ollama server is running with the model pulled.")
         return
 
-    eval_df = load_evaluation_data(EVALUATION_DATA_PATH)
-    results_df = run_evaluation(rag_pipeline, eval_df)
+    eval_rows = load_evaluation_data(EVALUATION_DATA_PATH)
+    results = run_evaluation(rag_pipeline, eval_rows)
 
     # Save the raw results for manual annotation
-    os.makedirs(os.path.dirname(EVALUATION_RESULTS_PATH), exist_ok=True)
-    results_df.to_csv(EVALUATION_RESULTS_PATH, index=False)
+    save_evaluation_results(results, EVALUATION_RESULTS_PATH)
     print(f"\nRaw evaluation results saved to: {EVALUATION_RESULTS_PATH}")
     print("\n--- Manual Assessment Required ---")
     print("Please open the CSV file and fill in the 'manual_...' columns.")
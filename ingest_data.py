@@ -6,11 +6,24 @@ Script for loading, chunking, embedding, and indexing documents into FAISS for t
 
 # --- Imports ---
 import os
+import re
+import math
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import faiss
+import numpy as np
 from langchain_community.document_loaders import DirectoryLoader, TextLoader, PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
 from langchain_huggingface import HuggingFaceEmbeddings  # Updated import for deprecation warning
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
 from config import *
+from query_assistant import (
+    set_faiss_search_params, load_embeddings_model, read_faiss_vectorstore, sentence_transformer, ONNXEmbeddings
+)
 
 
 # --- Document Loader Mapping ---
@@ -27,34 +40,109 @@ def get_document_loaders():
 
 
 # --- Document Loading ---
+def _load_file(file_path):
+    """
+    Loads a single file with the loader registered for its extension.
+    Args:
+        file_path (str): Path to the file.
+    Returns:
+        list: Documents loaded from the file (empty if loading failed).
+    """
+    file_loaders = get_document_loaders()
+    file_extension = os.path.splitext(file_path)[1].lower()
+    print(f"Loading {file_path}...")
+    try:
+        return file_loaders[file_extension](file_path).load()
+    except Exception as e:
+        print(f"Error loading {file_path}: {e}")
+        return []
+
+
 def load_documents(directory):
     """
     Loads documents from a specified directory using appropriate loaders.
+    Text files are read on a thread pool (I/O-bound); PDFs are parsed on a process pool (CPU-bound).
     Args:
         directory (str): Path to the directory containing documents.
     Returns:
         list: List of loaded documents.
     """
-    documents = []
     file_loaders = get_document_loaders()
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_extension = os.path.splitext(file_path)[1].lower()
-            if file_extension in file_loaders:
-                print(f"Loading {file_path}...")
-                try:
-                    loader = file_loaders[file_extension](file_path)
-                    documents.extend(loader.load())
-                except Exception as e:
-                    print(f"Error loading {file_path}: {e}")
-            else:
-                print(f"Skipping unsupported file: {file_path}")
+    text_paths, pdf_paths = [], []
+    for path in sorted(Path(directory).rglob("*")):
+        if not path.is_file():
+            continue
+        file_extension = path.suffix.lower()
+        if file_extension not in file_loaders:
+            print(f"Skipping unsupported file: {path}")
+        elif file_extension == ".pdf":
+            pdf_paths.append(str(path))
+        else:
+            text_paths.append(str(path))
+
+    documents = []
+    with ThreadPoolExecutor(max_workers=LOADER_MAX_WORKERS) as executor:
+        documents.extend(chain.from_iterable(executor.map(_load_file, text_paths)))
+    if pdf_paths:
+        with ProcessPoolExecutor() as executor:
+            documents.extend(chain.from_iterable(executor.map(_load_file, pdf_paths)))
     print(f"Loaded {len(documents)} raw documents.")
     return documents
 
 
 # --- Document Chunking ---
+# Candidate split points: paragraph breaks, then line breaks, then spaces (one group per level)
+_SEP_RE = re.compile(r"(\n\n)|(\n)|( )")
+
+
+def _split_text(text, chunk_size, chunk_overlap):
+    """
+    Splits text into chunks of at most chunk_size characters with about chunk_overlap characters of overlap.
+    Split points are found in a single regex pass. Each chunk ends at the last paragraph break in its
+    window if that keeps it at least half full, otherwise at the last line break, then the last space,
+    and only cuts mid-word when the window contains no separator.
+    Args:
+        text (str): Text to split.
+        chunk_size (int): Maximum chunk length in characters.
+        chunk_overlap (int): Target overlap between consecutive chunks in characters.
+    Returns:
+        list: List of chunk strings.
+    """
+    breaks_by_level = ([], [], [])
+    all_breaks = []
+    for match in _SEP_RE.finditer(text):
+        breaks_by_level[match.lastindex - 1].append(match.end())
+        all_breaks.append(match.end())
+
+    chunks = []
+    start, text_len = 0, len(text)
+    while start < text_len:
+        limit = start + chunk_size
+        if limit >= text_len:
+            end = text_len
+        else:
+            end = None
+            for level, breaks in enumerate(breaks_by_level):
+                idx = bisect_right(breaks, limit) - 1
+                # Paragraph/line breaks must leave the chunk at least half full; any space will do
+                min_end = start if level == 2 else start + chunk_size // 2
+                if idx >= 0 and breaks[idx] > min_end:
+                    end = breaks[idx]
+                    break
+            if end is None:
+                end = limit
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= text_len:
+            break
+        # Start the next chunk at the first separator inside the overlap window
+        idx = bisect_left(all_breaks, end - chunk_overlap)
+        next_start = all_breaks[idx] if idx < len(all_breaks) else end
+        start = next_start if start < next_start < end else end
+    return chunks
+
+
 def split_documents_into_chunks(documents, chunk_size, chunk_overlap):
     """
     Splits documents into smaller, overlapping chunks.
@@ -66,23 +154,14 @@ def split_documents_into_chunks(documents, chunk_size, chunk_overlap):
         list: List of chunked documents.
     """
     print(f"Splitting documents into chunks (size={chunk_size}, overlap={chunk_overlap})...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len,
-        separators=["\n\n", "\n", " ", ""] # Prioritize splitting by paragraphs, then lines, then words
-    )
-    chunks = text_splitter.split_documents(documents)
-    print(f"Created {len(chunks)} chunks.")
-    # Add metadata to each chunk for better tracking (if not already present from loader)
-    for i, chunk in enumerate(chunks):
-        if not hasattr(chunk, 'metadata'):
-            chunk.metadata = {}
-        chunk.metadata['chunk_id'] = i
-        # Attempt to get source if not already present (e.g., for TextLoader)
-        if 'source' not in chunk.metadata and hasattr(chunk, 'page_content'):
-            pass
-    return chunks
+    # Parallel text/metadata lists; each chunk gets a copy of its document's metadata plus its chunk_id
+    texts, metadatas = [], []
+    for document in documents:
+        for chunk_text in _split_text(document.page_content, chunk_size, chunk_overlap):
+            texts.append(chunk_text)
+            metadatas.append({**document.metadata, 'chunk_id': len(metadatas)})
+    print(f"Created {len(texts)} chunks.")
+    return [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
 
 
 # --- Embedding Generation ---
@@ -95,28 +174,106 @@ def generate_embeddings(chunks, model_name):
     Returns:
         HuggingFaceEmbeddings: The embedding model instance.
     """
-    print(f"Loading embedding model: {model_name}...")
-    embeddings_model = HuggingFaceEmbeddings(model_name=model_name)
-    print("Embedding model loaded.")
-    return embeddings_model
+    return load_embeddings_model(model_name)
+
+
+def encode_chunks(chunks, embeddings_model, batch_size):
+    """
+    Encodes all chunk texts in batches with the underlying SentenceTransformer or ONNX model.
+    Args:
+        chunks (list): List of document chunks.
+        embeddings_model (Embeddings): Embedding model instance (HuggingFaceEmbeddings or ONNXEmbeddings).
+        batch_size (int): Number of chunks per encode batch.
+    Returns:
+        np.ndarray: (N, dim) float32 matrix of L2-normalized embeddings, in chunk order.
+    """
+    texts = [chunk.page_content for chunk in chunks]
+    print(f"Encoding {len(texts)} chunks (batch_size={batch_size})...")
+    if isinstance(embeddings_model, ONNXEmbeddings):
+        return np.ascontiguousarray(embeddings_model.encode(texts), dtype=np.float32)
+    # encode() length-sorts the inputs before batching and restores the original order
+    xb = sentence_transformer(embeddings_model).encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=True,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    return np.ascontiguousarray(xb, dtype=np.float32)
+
+
+# --- FAISS Index Construction ---
+def build_faiss_index(xb):
+    """
+    Builds an inner-product IVF FAISS index (int8 scalar-quantized or PQ, see FAISS_ENCODING)
+    over an embedding matrix. Falls back to a flat index of the same precision when there
+    are too few vectors to train the quantizers.
+    Args:
+        xb (np.ndarray): (N, dim) float32 matrix of L2-normalized embeddings.
+    Returns:
+        faiss.Index: The trained and populated FAISS index.
+    """
+    # One contiguous float32 block, so train()/add() hand FAISS the buffer without a copy
+    xb = np.ascontiguousarray(xb, dtype=np.float32)
+    n, dim = xb.shape
+    nlist = FAISS_NLIST or max(1, round(math.sqrt(n)))
+    use_pq = FAISS_ENCODING == "PQ"
+    # Each PQ sub-quantizer learns 2**nbits centroids, so it needs at least that many training vectors
+    min_train = max(nlist, 2 ** FAISS_PQ_NBITS) if use_pq else nlist
+    if n < min_train:
+        # Per-dimension int8 needs no training beyond min/max ranges; PQ falls back to exact FP16
+        qtype = faiss.ScalarQuantizer.QT_fp16 if use_pq else faiss.ScalarQuantizer.QT_8bit
+        print(f"Only {n} vectors, too few to train an IVF index. Using flat {'FP16' if use_pq else 'SQ8'} index.")
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+    else:
+        quantizer = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        quantizer.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+        if use_pq:
+            print(f"Training IVF+PQ index (nlist={nlist}, M={FAISS_PQ_M}, nbits={FAISS_PQ_NBITS})...")
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, FAISS_PQ_M, FAISS_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        else:
+            print(f"Training IVF+SQ8 index (nlist={nlist})...")
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+        # Train the centroids with an exact flat assigner, then add them to the HNSW graph once
+        # (as index_factory("IVF..._HNSW...") does), instead of k-means assigning through the graph
+        index.quantizer_trains_alone = 2
+    index.train(xb)
+    # Sequential ids, so FAISS position i maps to docstore id str(i)
+    index.add(xb)
+    return index
 
 
 # --- FAISS Index Creation and Saving ---
-def create_and_save_faiss_index(chunks, embeddings_model, faiss_path):
+def create_and_save_faiss_index(chunks, xb, embeddings_model, faiss_path):
     """
-    Creates a FAISS index from chunks and embeddings, then saves it to disk.
+    Creates a FAISS index from chunks and their precomputed embeddings, then saves it to disk.
     Args:
         chunks (list): List of document chunks.
-        embeddings_model: Embedding model instance.
+        xb (np.ndarray): (N, dim) float32 embedding matrix, one row per chunk.
+        embeddings_model: Embedding model instance (used for query embeddings).
         faiss_path (str): Path to save the FAISS index.
     Returns:
         FAISS: The FAISS vectorstore instance.
     """
     print("Creating FAISS index...")
-    db = FAISS.from_documents(chunks, embeddings_model)
+    index = build_faiss_index(xb)
+    set_faiss_search_params(index)
+    docstore = InMemoryDocstore({str(i): chunk for i, chunk in enumerate(chunks)})
+    index_to_docstore_id = {i: str(i) for i in range(len(chunks))}
+    db = FAISS(
+        embedding_function=embeddings_model,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
     print(f"FAISS index created with {db.index.ntotal} vectors.")
     print(f"Saving FAISS index to {faiss_path}...")
     db.save_local(faiss_path)
+    # Keep the unquantized vectors for the exact brute-force scan (see RAGPipeline._init_brute_force)
+    np.save(os.path.join(faiss_path, FAISS_VECTORS_FILE), xb)
     print("FAISS index saved successfully.")
     return db
 
@@ -132,7 +289,7 @@ def load_faiss_index(faiss_path, embeddings_model):
         FAISS: The loaded FAISS vectorstore instance.
     """
     print(f"Loading FAISS index from {faiss_path}...")
-    db = FAISS.load_local(faiss_path, embeddings_model, allow_dangerous_deserialization=True)
+    db = read_faiss_vectorstore(faiss_path, embeddings_model)
     print("FAISS index loaded successfully.")
     return db
 
@@ -154,11 +311,12 @@ def main():
     # 2. Split into chunks
     chunks = split_documents_into_chunks(raw_documents, CHUNK_SIZE, CHUNK_OVERLAP)
 
-    # 3. Generate embeddings model
+    # 3. Load embeddings model and encode all chunks in batches
     embeddings_model = generate_embeddings(chunks, EMBEDDING_MODEL_NAME)
+    xb = encode_chunks(chunks, embeddings_model, EMBEDDING_BATCH_SIZE)
 
     # 4. Create and save FAISS index
-    create_and_save_faiss_index(chunks, embeddings_model, FAISS_INDEX_PATH)
+    create_and_save_faiss_index(chunks, xb, embeddings_model, FAISS_INDEX_PATH)
 
     print("\nData ingestion pipeline completed!")
     print(f"Knowledge base indexed and saved to {FAISS_INDEX_PATH}")
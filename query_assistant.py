@@ -6,15 +6,231 @@ Helper functions for loading FAISS index, embeddings, and initializing LLMs for
 
 # --- Imports ---
 import os
-from langchain_huggingface import HuggingFaceEmbeddings, HuggingFacePipeline
+import copy
+import asyncio
+import contextlib
+import functools
+import pickle
+import threading
+import importlib.util
+import numpy as np
+import faiss
+import torch
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, StaticCache, TextIteratorStreamer,
+    StoppingCriteria, StoppingCriteriaList
+)
+from transformers.pipelines import pipeline
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import FAISS
-from config import FAISS_INDEX_PATH, EMBEDDING_MODEL_NAME, LLM_MODEL_NAME, PROMPT_TEMPLATE
-from typing import Tuple, Any
+from langchain_community.vectorstores.utils import DistanceStrategy
+from config import (
+    FAISS_INDEX_PATH, EMBEDDING_MODEL_NAME, LLM_MODEL_NAME, PROMPT_PREFIX, PROMPT_MIDDLE, PROMPT_SUFFIX,
+    FAISS_NPROBE, FAISS_HNSW_EF_SEARCH,
+    LLM_MAX_NEW_TOKENS, LLM_TORCH_COMPILE, LLM_QUANTIZATION, LLM_BATCH_SIZE, LLM_ATTN_IMPLEMENTATION,
+    LLM_PREFIX_CACHE, LLM_MAX_CACHE_LEN, LLM_BACKEND, LLM_BASE_URL, LLM_ONNX_DIR,
+    LLM_ASSISTANT_MODEL_NAME, LLM_PROMPT_LOOKUP_TOKENS, LLM_STOP_SEQUENCES, CHUNK_SIZE,
+    EMBEDDING_TORCH_COMPILE, EMBEDDING_BACKEND, EMBEDDING_ONNX_DIR, EMBEDDING_BATCH_SIZE
+)
+from typing import Tuple, Any, List, Optional, Iterator
+
+# Let torch intra-op parallelism use every available core for embedding/LLM forward passes
+torch.set_num_threads(os.cpu_count() or 1)
+
+# --- FAISS Search Parameters ---
+def set_faiss_search_params(index: Any) -> None:
+    """
+    Applies query-time search parameters to a FAISS index.
+    Sets nprobe on IVF indexes (and efSearch on an HNSW coarse quantizer);
+    exact (flat) indexes are left untouched.
+    Args:
+        index (Any): The FAISS index to configure.
+    """
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        ivf_index.nprobe = FAISS_NPROBE
+        quantizer = faiss.downcast_index(ivf_index.quantizer)
+        if isinstance(quantizer, faiss.IndexHNSW):
+            quantizer.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+
+# --- ONNX Runtime Embeddings ---
+class ONNXEmbeddings(Embeddings):
+    """
+    LangChain embeddings backed by an INT8 dynamically-quantized ONNX export of a
+    sentence-transformers model, run with ONNX Runtime on CPU.
+    Produces the same mean-pooled, L2-normalized vectors as the torch backend.
+    """
+
+    def __init__(self, model_name: str, export_dir: str, batch_size: int = EMBEDDING_BATCH_SIZE):
+        """
+        Args:
+            model_name (str): HuggingFace model to export on first use.
+            export_dir (str): Directory holding the exported and quantized ONNX models.
+            batch_size (int): Number of texts per inference batch.
+        """
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        quantized_dir = os.path.join(export_dir, "quantized")
+        if not os.path.exists(quantized_dir):
+            self._export_and_quantize(model_name, export_dir, quantized_dir)
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = os.cpu_count() or 1
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            quantized_dir, file_name="model_quantized.onnx", session_options=session_options
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(quantized_dir)
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _export_and_quantize(model_name: str, export_dir: str, quantized_dir: str) -> None:
+        """
+        Exports the model to ONNX and applies dynamic INT8 (QOperator) quantization.
+        """
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        print(f"Exporting {model_name} to ONNX in {export_dir}...")
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        model.save_pretrained(export_dir)
+        quantizer = ORTQuantizer.from_pretrained(export_dir)
+        quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=quantized_dir, quantization_config=quantization_config)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(quantized_dir)
+        print("ONNX export and quantization complete.")
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encodes texts into an (N, dim) float32 matrix of L2-normalized embeddings.
+        Texts are length-sorted before batching to minimize padding, then restored to input order.
+        """
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            batch_texts = [texts[i] for i in order[start:start + self.batch_size]]
+            inputs = self.tokenizer(batch_texts, padding=True, truncation=True, max_length=256, return_tensors="np")
+            token_embeddings = self.model(**inputs).last_hidden_state
+            # Mean pooling over real (non-padding) tokens, as in the sentence-transformers model
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            batches.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True).clip(1e-12))
+        if not batches:
+            return np.empty((0, 0), dtype=np.float32)
+        xb = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        xb[order] = np.concatenate(batches)
+        return xb
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+# --- Embedding Model Loader ---
+def sentence_transformer(embeddings_model: HuggingFaceEmbeddings) -> Any:
+    """
+    Returns the SentenceTransformer wrapped by a HuggingFaceEmbeddings instance
+    (a private attribute in recent langchain-huggingface releases).
+    """
+    client = getattr(embeddings_model, "_client", None)
+    return client if client is not None else embeddings_model.client
+
+
+def use_onnx_embeddings() -> bool:
+    """
+    Resolves EMBEDDING_BACKEND to whether the ONNX Runtime backend should be used.
+    """
+    if EMBEDDING_BACKEND == "auto":
+        return (
+            not torch.cuda.is_available()
+            and importlib.util.find_spec("optimum") is not None
+            and importlib.util.find_spec("onnxruntime") is not None
+        )
+    return EMBEDDING_BACKEND == "onnx"
+
+
+@functools.lru_cache(maxsize=1)
+def load_embeddings_model(embedding_model_name: str) -> Embeddings:
+    """
+    Loads the embedding model once per process: on GPU when available, otherwise
+    through ONNX Runtime if configured (see EMBEDDING_BACKEND).
+    Args:
+        embedding_model_name (str): Name of the embedding model.
+    Returns:
+        Embeddings: The embedding model instance (HuggingFaceEmbeddings or ONNXEmbeddings).
+    """
+    print(f"Loading embedding model: {embedding_model_name}...")
+    if use_onnx_embeddings():
+        embeddings_model = ONNXEmbeddings(embedding_model_name, EMBEDDING_ONNX_DIR)
+        print("Embedding model loaded (ONNX Runtime).")
+        return embeddings_model
+    if torch.cuda.is_available():
+        # Half-precision weights halve the bytes read per forward pass; CPUs lack fast fp16 matmuls
+        model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+    else:
+        model_kwargs = {"device": "cpu"}
+    embeddings_model = HuggingFaceEmbeddings(
+        model_name=embedding_model_name,
+        model_kwargs=model_kwargs,
+        # embed_documents() (batched queries) goes through SentenceTransformer.encode, which
+        # length-sorts inputs so each batch is only padded to its own longest text
+        encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE, "normalize_embeddings": True}
+    )
+    # CPU compilation needs a C++ toolchain for inductor and gains little over the eager model
+    if EMBEDDING_TORCH_COMPILE and torch.cuda.is_available():
+        # Token counts vary per batch, so compile with dynamic shapes instead of one graph per length
+        transformer = sentence_transformer(embeddings_model)[0]
+        eager_model = transformer.auto_model
+        transformer.auto_model = torch.compile(eager_model, dynamic=True)
+        print("Warming up compiled embedding model...")
+        try:
+            embeddings_model.embed_query("warmup")
+        except Exception as e:
+            # Compilation errors surface on the first call; keep serving with the eager model
+            print(f"torch.compile failed for the embedding model, using it uncompiled: {e}")
+            transformer.auto_model = eager_model
+    print("Embedding model loaded.")
+    return embeddings_model
+
+# --- Memory-Mapped FAISS Loading ---
+def read_faiss_vectorstore(faiss_path: str, embeddings_model: Any) -> FAISS:
+    """
+    Loads a vectorstore written by FAISS.save_local, memory-mapping the index file
+    (IO_FLAG_MMAP | IO_FLAG_READ_ONLY) instead of deserializing it into RAM, so the
+    OS pages vectors in on demand. Falls back to a regular read for index types
+    that this FAISS build cannot mmap.
+    Note: the first queries touch the coarse centroids; on large indexes, callers
+    may madvise(MADV_WILLNEED) that region to avoid page-fault latency.
+    Args:
+        faiss_path (str): Directory containing index.faiss and index.pkl.
+        embeddings_model: Embedding model instance.
+    Returns:
+        FAISS: The loaded FAISS vectorstore instance.
+    """
+    index_file = os.path.join(faiss_path, "index.faiss")
+    try:
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        index = faiss.read_index(index_file)
+    # index.pkl is our own ingestion output (same trust model as allow_dangerous_deserialization)
+    with open(os.path.join(faiss_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    set_faiss_search_params(index)
+    return FAISS(
+        embedding_function=embeddings_model,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
 
 # --- FAISS Index and Embeddings Loader ---
+@functools.lru_cache(maxsize=1)
 def load_faiss_index_and_embeddings(faiss_path: str, embedding_model_name: str) -> Tuple[Any, Any]:
     """
-    Loads the FAISS index and embedding model.
+    Loads the FAISS index and embedding model. Cached, so repeated calls with the
+    same arguments reuse the already-loaded instances.
     Args:
         faiss_path (str): Path to the FAISS index file.
         embedding_model_name (str): Name of the embedding model.
@@ -25,39 +241,472 @@ def load_faiss_index_and_embeddings(faiss_path: str, embedding_model_name: str)
     """
     if not os.path.exists(faiss_path):
         raise FileNotFoundError(f"FAISS index not found at {faiss_path}. Please run ingest_data.py first.")
-    print(f"Loading embedding model: {embedding_model_name}...")
-    embeddings_model = HuggingFaceEmbeddings(model_name=embedding_model_name)
-    print("Embedding model loaded.")
+    embeddings_model = load_embeddings_model(embedding_model_name)
     print(f"Loading FAISS index from {faiss_path}...")
-    db = FAISS.load_local(faiss_path, embeddings_model, allow_dangerous_deserialization=True)
+    db = read_faiss_vectorstore(faiss_path, embeddings_model)
     print("FAISS index loaded successfully.")
     return db, embeddings_model
 
+# --- Stop Sequences ---
+class StopOnStrings(StoppingCriteria):
+    """
+    Stops generation of each sequence once its text ends with one of the stop strings.
+    Only the last few tokens are decoded per step, and since the check is a suffix match
+    made after every new token, stop strings inside the prompt never trigger it.
+    """
+
+    def __init__(self, tokenizer: Any, stop_strings: List[str]):
+        self.tokenizer = tokenizer
+        self.stop_strings = tuple(stop_strings)
+        # Enough trailing tokens to cover the longest stop string, plus slack for merges
+        self.window = max(len(tokenizer.encode(s, add_special_tokens=False)) for s in stop_strings) + 2
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs) -> Any:
+        tails = self.tokenizer.batch_decode(input_ids[:, -self.window:])
+        return torch.tensor(
+            [tail.endswith(self.stop_strings) for tail in tails], dtype=torch.bool, device=input_ids.device
+        )
+
+# --- Prompt Construction ---
+class PromptText(str):
+    """
+    A filled-in PROMPT_TEMPLATE that also keeps its variable parts, so PrefixCachedLLM can
+    tokenize only those and reuse the pre-tokenized template segments. Behaves as a plain str.
+    """
+
+    def __new__(cls, context: str, question: str):
+        prompt = super().__new__(cls, PROMPT_PREFIX + context + PROMPT_MIDDLE + question + PROMPT_SUFFIX)
+        prompt.context = context
+        prompt.question = question
+        return prompt
+
+
+def build_prompt(context: str, question: str) -> PromptText:
+    """
+    Equivalent to PROMPT_TEMPLATE.format(context=context, question=question).
+    """
+    return PromptText(context, question)
+
+
+# SentencePiece tokenizers prepend "▁" to the start of every encode call, so prompt segments are
+# encoded after this anchor and the anchor's tokens dropped, giving the tokens they get mid-prompt
+_SEGMENT_ANCHOR = "\n"
+
+# Sample prompts used to check that segment-wise tokenization reproduces full-prompt tokenization
+_SEGMENT_PROBES = (
+    ("The Sun is a G-type main-sequence star.", "What type of star is the Sun?"),
+    ("4.6 billion years ago, the Solar System formed from a molecular cloud.", "How old is the Solar System?"),
+)
+
+# --- Prefix-Cached LLM ---
+class PrefixCachedLLM:
+    """
+    Text-generation wrapper that computes the KV cache of a fixed prompt prefix once
+    and reuses it, so each query only prefills the tokens that follow the prefix.
+    Like a LangChain LLM, it exposes invoke/batch/stream; all return only the generated text.
+    """
+
+    def __init__(self, pipe: Any, prefix_text: Optional[str], assist_kwargs: Optional[dict] = None):
+        """
+        Args:
+            pipe (Any): HuggingFace text-generation pipeline (also used for batched generation).
+            prefix_text (Optional[str]): Static text prompts start with, or None to disable prefix caching.
+            assist_kwargs (Optional[dict]): Speculative-decoding arguments for single-prompt generate() calls.
+        """
+        self.pipe = pipe
+        self.model = pipe.model
+        self.tokenizer = pipe.tokenizer
+        self.assist_kwargs = assist_kwargs or {}
+        self.stopping_criteria = StoppingCriteriaList([StopOnStrings(self.tokenizer, LLM_STOP_SEQUENCES)])
+        self.prefix_text = prefix_text
+        self._prefix_kv = None
+        # Idle prefix-seeded caches, reused across requests (one per concurrent request at most)
+        self._cache_pool = []
+        self._cache_pool_lock = threading.Lock()
+        # With cache_implementation="static", generate() keeps one cache on the model and resets it
+        # on every call, so generate calls that don't bring a pooled cache must not overlap
+        generation_config = getattr(self.model, "generation_config", None)
+        uses_model_cache = getattr(generation_config, "cache_implementation", None) == "static"
+        self._model_cache_lock = threading.Lock() if uses_model_cache else contextlib.nullcontext()
+        if prefix_text is None:
+            return
+        self.prefix_ids = self.tokenizer(prefix_text, return_tensors="pt").input_ids.to(self.model.device)
+        self._segmented = False
+        if prefix_text == PROMPT_PREFIX:
+            self._prefix_id_list = self.prefix_ids[0].tolist()
+            self._anchor_ids = self.tokenizer(_SEGMENT_ANCHOR, add_special_tokens=False).input_ids
+            # Static template segments between/after the variable parts, tokenized once. Trailing
+            # spaces of the middle segment go with the question, where they merge into its first token
+            middle_core = PROMPT_MIDDLE.rstrip(" ")
+            self._question_lead = PROMPT_MIDDLE[len(middle_core):]
+            self.middle_ids = self._encode_segment(middle_core)
+            self.suffix_ids = self._encode_segment(PROMPT_SUFFIX)
+            self._segmented = self.middle_ids is not None and self.suffix_ids is not None and all(
+                self._segmented_ids(probe) == self.tokenizer(probe).input_ids
+                for probe in (PromptText(context, question) for context, question in _SEGMENT_PROBES)
+            )
+            if not self._segmented:
+                print("Segment-wise prompt tokenization does not match this tokenizer; tokenizing full prompts.")
+        # Same cache type as generation_config.cache_implementation ("static"), sized for prefix + tail + answer
+        prefix_cache = StaticCache(
+            config=self.model.config,
+            max_batch_size=1,
+            max_cache_len=LLM_MAX_CACHE_LEN,
+            device=self.model.device,
+            dtype=self.model.dtype
+        )
+        # Explicit positions, so the model does not derive them from the cache's (tensor) sequence length
+        cache_position = torch.arange(self.prefix_ids.shape[-1], device=self.model.device)
+        with torch.no_grad():
+            self._prefix_kv = self.model(
+                self.prefix_ids, past_key_values=prefix_cache, cache_position=cache_position, use_cache=True
+            ).past_key_values
+
+    def _strip_anchor(self, ids: List[int]) -> Optional[List[int]]:
+        """
+        Drops the anchor tokens from an anchor-prefixed encoding, or returns None if the
+        segment's first token merged with the anchor.
+        """
+        anchor_len = len(self._anchor_ids)
+        if ids[:anchor_len] != self._anchor_ids:
+            return None
+        return ids[anchor_len:]
+
+    def _encode_segment(self, text: str) -> Optional[List[int]]:
+        """
+        Tokenizes text as it is tokenized in the middle of a prompt (see _SEGMENT_ANCHOR).
+        """
+        return self._strip_anchor(self.tokenizer(_SEGMENT_ANCHOR + text, add_special_tokens=False).input_ids)
+
+    def _segmented_ids(self, prompt: PromptText) -> Optional[List[int]]:
+        """
+        Token ids of a PromptText, tokenizing only its context and question.
+        Returns None if either segment cannot be encoded on its own.
+        """
+        context_ids, question_ids = (
+            self._strip_anchor(ids) for ids in self.tokenizer(
+                [_SEGMENT_ANCHOR + prompt.context, _SEGMENT_ANCHOR + self._question_lead + prompt.question],
+                add_special_tokens=False
+            ).input_ids
+        )
+        if context_ids is None or question_ids is None:
+            return None
+        return self._prefix_id_list + context_ids + self.middle_ids + question_ids + self.suffix_ids
+
+    def _prefix_cached_ids(self, prompt: str) -> Optional[Any]:
+        """
+        Tokenizes a prompt for the prefix-cached path.
+        Returns:
+            Optional[Any]: (1, seq_len) input ids starting with prefix_ids, or None if the prompt
+            does not start with the cached prefix once tokenized.
+        """
+        if self._prefix_kv is None or not prompt.startswith(self.prefix_text):
+            return None
+        if self._segmented and isinstance(prompt, PromptText):
+            # Only the retrieved context and the question need tokenizing
+            ids = self._segmented_ids(prompt)
+            if ids is not None:
+                return torch.tensor([ids], device=self.model.device)
+        # Tokenize the whole prompt, exactly like batch() does: encoding the tail on its own would
+        # gain a spurious leading "▁" from SentencePiece. Tokens can also merge across the prefix
+        # boundary, so the cache only applies if the prefix tokens come out unchanged.
+        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.model.device)
+        prefix_len = self.prefix_ids.shape[-1]
+        if not torch.equal(input_ids[:, :prefix_len], self.prefix_ids):
+            return None
+        return input_ids
+
+    @staticmethod
+    def _cache_tensors(cache: Any) -> List[Any]:
+        """
+        The key and value tensors of every layer of a StaticCache.
+        """
+        if hasattr(cache, "layers"):  # Per-layer cache objects in newer transformers releases
+            return [tensor for layer in cache.layers for tensor in (layer.keys, layer.values)]
+        return list(cache.key_cache) + list(cache.value_cache)
+
+    def _acquire_prefix_cache(self) -> Any:
+        """
+        Takes an idle prefix cache from the pool, or allocates one, and resets it to the prefix state.
+        The cache tensors are overwritten in place, so a cache keeps its device addresses across
+        requests and compiled code that captured them can be reused.
+        """
+        with self._cache_pool_lock:
+            cache = self._cache_pool.pop() if self._cache_pool else None
+        if cache is None:
+            return copy.deepcopy(self._prefix_kv)
+        # The prefix cache holds the prefix KV followed by zeros, so one copy also clears the previous request
+        for dst, src in zip(self._cache_tensors(cache), self._cache_tensors(self._prefix_kv)):
+            dst.copy_(src)
+        return cache
+
+    def _release_prefix_cache(self, cache: Any) -> None:
+        """
+        Returns a cache taken with _acquire_prefix_cache() to the pool.
+        """
+        with self._cache_pool_lock:
+            self._cache_pool.append(cache)
+
+    def _generate_ids(self, prompt: str, **generate_kwargs) -> Tuple[Any, int]:
+        """
+        Runs generate() for a single prompt, reusing the prefix KV cache when the prompt starts with it.
+        Returns:
+            Tuple[Any, int]: (output token ids, number of prompt tokens)
+        """
+        generate_kwargs = {**self.assist_kwargs, "stopping_criteria": self.stopping_criteria, **generate_kwargs}
+        input_ids = self._prefix_cached_ids(prompt)
+        prefix_cache = None
+        # Prompts whose answer could overflow the LLM_MAX_CACHE_LEN prefix cache are generated
+        # without it (the default static cache is then sized for the prompt instead)
+        if input_ids is not None and input_ids.shape[-1] + LLM_MAX_NEW_TOKENS <= LLM_MAX_CACHE_LEN:
+            # generate() gets the full sequence but skips prefill for the positions already in the cache.
+            # Each in-flight request holds its own pooled cache, so these requests never share state.
+            prefix_cache = self._acquire_prefix_cache()
+            generate_kwargs.update(past_key_values=prefix_cache, cache_implementation=None)
+        elif input_ids is None:
+            input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.model.device)
+        # Without a pooled cache, generate() uses the model's shared static cache
+        model_cache_guard = self._model_cache_lock if prefix_cache is None else contextlib.nullcontext()
+        try:
+            with model_cache_guard, torch.no_grad():
+                output_ids = self.model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    **generate_kwargs
+                )
+        finally:
+            if prefix_cache is not None:
+                self._release_prefix_cache(prefix_cache)
+        return output_ids, input_ids.shape[-1]
+
+    def invoke(self, prompt: str) -> str:
+        """
+        Generates an answer for a single prompt.
+        """
+        output_ids, prompt_len = self._generate_ids(prompt)
+        return self.tokenizer.decode(output_ids[0, prompt_len:], skip_special_tokens=True)
+
+    async def ainvoke(self, prompt: str) -> str:
+        """
+        Async variant of invoke(); generation runs in a worker thread so the event loop stays free.
+        """
+        return await asyncio.to_thread(self.invoke, prompt)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        """
+        Generates an answer for a single prompt, yielding text chunks as tokens are decoded.
+        """
+        # One streamer per call: a shared streamer would interleave concurrent requests
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def run_generation():
+            try:
+                self._generate_ids(prompt, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()  # Unblock the consumer loop below
+
+        thread = threading.Thread(target=run_generation, daemon=True)
+        thread.start()
+        yield from streamer
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def batch(self, prompts: List[str]) -> List[str]:
+        """
+        Generates answers for several prompts in padded batches (without the prefix cache).
+        """
+        with self._model_cache_lock:
+            outputs = self.pipe(prompts, stopping_criteria=self.stopping_criteria)
+        return [output[0]["generated_text"] for output in outputs]
+
+
+# --- LLM Attention Backend ---
+def _attn_implementation(static_cache: bool) -> str:
+    """
+    Resolves LLM_ATTN_IMPLEMENTATION: FlashAttention-2 needs CUDA and the flash-attn package,
+    otherwise PyTorch's fused scaled_dot_product_attention kernels are used.
+    Args:
+        static_cache (bool): Whether the model runs with a StaticCache (and possibly torch.compile).
+            Several transformers releases reject StaticCache with FlashAttention-2, so "auto"
+            only picks it for the dynamic cache.
+    """
+    if LLM_ATTN_IMPLEMENTATION != "auto":
+        return LLM_ATTN_IMPLEMENTATION
+    if static_cache:
+        return "sdpa"
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+# --- vLLM Server Client ---
+def initialize_vllm_client(model_name: str) -> Any:
+    """
+    Connects to an OpenAI-compatible vLLM server at LLM_BASE_URL. The server's
+    PagedAttention scheduler continuously batches requests from concurrent callers.
+    Args:
+        model_name (str): Name of the model served by vLLM.
+    Returns:
+        VLLMOpenAI: LangChain LLM exposing invoke/ainvoke/stream/batch, like PrefixCachedLLM.
+    """
+    from langchain_community.llms import VLLMOpenAI
+    print(f"Connecting to vLLM server at {LLM_BASE_URL} (model: {model_name})...")
+    return VLLMOpenAI(
+        openai_api_base=LLM_BASE_URL,
+        openai_api_key="EMPTY",
+        model_name=model_name,
+        max_tokens=LLM_MAX_NEW_TOKENS,
+        temperature=0.0,  # Greedy, like the in-process backends
+        model_kwargs={"stop": LLM_STOP_SEQUENCES},
+        batch_size=LLM_BATCH_SIZE
+    )
+
+# --- ONNX Runtime LLM ---
+def initialize_onnx_llm(model_name: str) -> PrefixCachedLLM:
+    """
+    Loads the LLM as an ONNX Runtime model (exported on first use and cached in LLM_ONNX_DIR).
+    On CUDA, inputs and the KV cache stay on the GPU between steps through IOBinding.
+    The prefix cache and static KV cache are transformers-only, so they are not used here.
+    Args:
+        model_name (str): Name of the HuggingFace model to export.
+    Returns:
+        PrefixCachedLLM: The initialized LLM (without prefix caching).
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM
+    print(f"Initializing ONNX Runtime LLM: {model_name}...")
+    use_cuda = torch.cuda.is_available()
+    ort_kwargs = dict(
+        provider="CUDAExecutionProvider" if use_cuda else "CPUExecutionProvider",
+        use_io_binding=use_cuda
+    )
+    if os.path.exists(LLM_ONNX_DIR):
+        model = ORTModelForCausalLM.from_pretrained(LLM_ONNX_DIR, **ort_kwargs)
+        tokenizer = AutoTokenizer.from_pretrained(LLM_ONNX_DIR)
+    else:
+        print(f"Exporting {model_name} to ONNX in {LLM_ONNX_DIR} (one-off)...")
+        model = ORTModelForCausalLM.from_pretrained(model_name, export=True, **ort_kwargs)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model.save_pretrained(LLM_ONNX_DIR)
+        tokenizer.save_pretrained(LLM_ONNX_DIR)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    model.generation_config.max_new_tokens = LLM_MAX_NEW_TOKENS
+    model.generation_config.do_sample = False
+    pipe = pipeline(
+        "text-generation",
+        model=model,
+        tokenizer=tokenizer,
+        max_new_tokens=LLM_MAX_NEW_TOKENS,
+        pad_token_id=tokenizer.eos_token_id,
+        batch_size=LLM_BATCH_SIZE,
+        return_full_text=False
+    )
+    llm = PrefixCachedLLM(pipe, None)
+    print(f"ONNX Runtime LLM '{model_name}' initialized successfully.")
+    return llm
+
 # --- LLM Initialization ---
-def initialize_llm(model_name: str) -> HuggingFacePipeline:
+def initialize_llm(model_name: str) -> Any:
     """
-    Initializes the HuggingFacePipeline LLM.
+    Initializes the LLM with a static KV cache, a cached prompt-prefix KV state and,
+    if enabled, a torch.compile'd forward pass (warmed up before returning).
+    With LLM_BACKEND = "onnx" or "vllm", returns an ONNX Runtime model or a vLLM server client instead.
     Args:
         model_name (str): Name of the HuggingFace model to load.
     Returns:
-        HuggingFacePipeline: The initialized LLM pipeline.
+        PrefixCachedLLM | VLLMOpenAI: The initialized LLM.
     """
-    print(f"Initializing HuggingFacePipeline LLM: {model_name}...")
+    if LLM_BACKEND == "vllm":
+        return initialize_vllm_client(model_name)
+    if LLM_BACKEND == "onnx":
+        return initialize_onnx_llm(model_name)
+    print(f"Initializing HuggingFace LLM: {model_name}...")
     try:
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        from transformers.pipelines import pipeline
         tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModelForCausalLM.from_pretrained(model_name)
+        # Batched generation needs a pad token, and decoder-only models must be padded on the left
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        quantization_config = None
+        if LLM_QUANTIZATION == "4bit" and torch.cuda.is_available():
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True
+            )
+        elif LLM_QUANTIZATION == "8bit" and torch.cuda.is_available():
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        # Assisted generation rolls back rejected tokens, which needs a growable (dynamic) KV cache
+        use_static_cache = not (LLM_ASSISTANT_MODEL_NAME or LLM_PROMPT_LOOKUP_TOKENS)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16,
+            attn_implementation=_attn_implementation(use_static_cache),
+            quantization_config=quantization_config,
+            device_map="auto"
+        )
+        model.generation_config.max_new_tokens = LLM_MAX_NEW_TOKENS
+        # Greedy decoding: deterministic grounded answers, no sampling work per step
+        model.generation_config.do_sample = False
+        # Speculative decoding: drafted tokens are verified in one forward pass of the full model
+        assist_kwargs = {}
+        if LLM_ASSISTANT_MODEL_NAME:
+            print(f"Loading assistant model for speculative decoding: {LLM_ASSISTANT_MODEL_NAME}...")
+            assist_kwargs["assistant_model"] = AutoModelForCausalLM.from_pretrained(
+                LLM_ASSISTANT_MODEL_NAME,
+                torch_dtype=torch.bfloat16,
+                attn_implementation=_attn_implementation(static_cache=False),
+                device_map="auto"
+            )
+        elif LLM_PROMPT_LOOKUP_TOKENS:
+            assist_kwargs["prompt_lookup_num_tokens"] = LLM_PROMPT_LOOKUP_TOKENS
+        if use_static_cache:
+            # Pre-allocate the KV cache at its maximum length so every decode step has the same shapes
+            model.generation_config.cache_implementation = "static"
+        # CPU compilation needs a C++ toolchain for inductor, and its long warm-up would delay serving
+        compile_llm = LLM_TORCH_COMPILE and use_static_cache and torch.cuda.is_available()
+        eager_forward = model.forward
+        if compile_llm:
+            # "reduce-overhead" lets torch.compile cut per-step launch overhead (via CUDA graphs where the
+            # shapes and buffers allow it); the static KV cache keeps decode-step shapes fixed.
+            # bitsandbytes matmuls cause graph breaks, so only demand a single graph for unquantized weights
+            model.forward = torch.compile(
+                model.forward, mode="reduce-overhead", fullgraph=quantization_config is None
+            )
         pipe = pipeline(
             "text-generation",
             model=model,
             tokenizer=tokenizer,
-            max_new_tokens=512,
+            max_new_tokens=LLM_MAX_NEW_TOKENS,
             pad_token_id=tokenizer.eos_token_id,
-            device=0
+            batch_size=LLM_BATCH_SIZE,
+            return_full_text=False  # Only the newly generated text, no copy of the prompt
         )
-        llm = HuggingFacePipeline(pipeline=pipe)
-        print(f"HuggingFacePipeline LLM '{model_name}' initialized successfully.")
+        # Everything before {context} is identical for every query
+        prefix_text = PROMPT_PREFIX if LLM_PREFIX_CACHE and use_static_cache else None
+        try:
+            llm = PrefixCachedLLM(pipe, prefix_text, assist_kwargs)
+            if compile_llm:
+                print("Warming up compiled LLM (first compilation can take a while)...")
+                # A chunk-sized context and a typical question, so the warm-up compiles for
+                # realistic prompt lengths rather than a toy input. Only the single-prompt path is
+                # warmed: generate() reallocates the model's static cache for every new batch size
+                # or longer prompt, so batched requests compile for their own shapes on first use.
+                warmup_prompt = build_prompt(("The Sun is a star. " * CHUNK_SIZE)[:CHUNK_SIZE], "What is the Sun?")
+                llm.invoke(warmup_prompt)
+        except Exception as e:
+            if not compile_llm:
+                raise
+            # Compilation errors surface on the first call; keep serving with the eager model
+            print(f"torch.compile failed for the LLM, using it uncompiled: {e}")
+            model.forward = eager_forward
+            llm = PrefixCachedLLM(pipe, prefix_text, assist_kwargs)
+        print(f"HuggingFace LLM '{model_name}' initialized successfully.")
         return llm
     except Exception as e:
         print(f"Error initializing LLM: {e}")
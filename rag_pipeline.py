@@ -6,12 +6,27 @@ Core RAG pipeline class for retrieval, LLM inference, and answer extraction.
 
 # --- Imports ---
 import os
+import re
+import asyncio
+import functools
+import numpy as np
 from langchain_huggingface import HuggingFaceEmbeddings, HuggingFacePipeline
 from langchain_community.vectorstores import FAISS
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
 from langchain.schema import Document # Import Document for type hinting if needed
 from config import *
+from query_assistant import load_faiss_index_and_embeddings, initialize_llm, build_prompt
+
+try:
+    import simsimd  # Optional: SIMD dot-product kernels for the brute-force scan
+except ImportError:
+    simsimd = None
+
+# Generation already halts on these; the cut removes the stop string itself (and catches tokenizer edge cases)
+_STOP_RE = re.compile("|".join(re.escape(stop) for stop in LLM_STOP_SEQUENCES))
+
+NO_INFO_ANSWER = "I'm sorry, but I don't have enough information to answer that based on the provided knowledge base."
 
 
 # --- RAG Pipeline Class ---
@@ -24,6 +39,14 @@ class RAGPipeline:
         self.embeddings_model = None
         self.llm = None
         self.qa_chain = None
+        # Brute-force search state: the (N, dim) vector matrix split into leading/trailing
+        # dimensions, norms of the trailing parts, and the Document of each row
+        self._doc_head = None
+        self._doc_tail = None
+        self._tail_norms = None
+        self._docs = None
+        # Per-instance LRU of query embeddings, keyed by the normalized query text
+        self._embed_normalized = functools.lru_cache(maxsize=512)(self._embed_uncached)
         self._initialize_pipeline()
 
     def _initialize_pipeline(self):
@@ -31,73 +54,191 @@ class RAGPipeline:
         Initializes the embedding model, loads FAISS index, and sets up HuggingFace LLM.
         """
         print("Initializing RAG Pipeline components...")
-        # 1. Load embedding model
+        # 1-2. Load embedding model and FAISS index (shared, loaded once per process)
         try:
-            self.embeddings_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
-            print("Embedding model loaded.")
-        except Exception as e:
-            print(f"Error loading embedding model: {e}")
-            raise
-
-        # 2. Load FAISS index
-        if not os.path.exists(FAISS_INDEX_PATH):
-            raise FileNotFoundError(
-                f"FAISS index not found at {FAISS_INDEX_PATH}. "
-                "Please run ingest_data.py first to create the index."
+            self.vectorstore, self.embeddings_model = load_faiss_index_and_embeddings(
+                FAISS_INDEX_PATH, EMBEDDING_MODEL_NAME
             )
-        try:
-            self.vectorstore = FAISS.load_local(FAISS_INDEX_PATH, self.embeddings_model, allow_dangerous_deserialization=True)
-            print("FAISS index loaded successfully.")
         except Exception as e:
-            print(f"Error loading FAISS index: {e}")
+            print(f"Error loading embedding model or FAISS index: {e}")
             raise
+        self._init_brute_force()
 
         # 3. Initialize HuggingFace LLM
         try:
-            from transformers import AutoModelForCausalLM, AutoTokenizer
-            from transformers.pipelines import pipeline
-            print(f"Initializing HuggingFacePipeline LLM: {LLM_MODEL_NAME}...")
-            tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_NAME)
-            model = AutoModelForCausalLM.from_pretrained(LLM_MODEL_NAME)
-            pipe = pipeline(
-                "text-generation",
-                model=model,
-                tokenizer=tokenizer,
-                max_new_tokens=512,
-                pad_token_id=tokenizer.eos_token_id,
-                device=0
-            )
-            self.llm = HuggingFacePipeline(pipeline=pipe)
-            print(f"HuggingFacePipeline LLM '{LLM_MODEL_NAME}' initialized successfully.")
+            self.llm = initialize_llm(LLM_MODEL_NAME)
         except Exception as e:
             print(f"Error initializing HuggingFace LLM: {e}")
             print("Please ensure the model is available and your environment has the required dependencies.")
             raise
 
 
-    def _get_relevant_documents_with_threshold(self, query: str):
+    def _init_brute_force(self):
+        """
+        Caches the indexed vectors as contiguous matrices for _top1_with_threshold(), when the
+        corpus is small enough (BRUTE_FORCE_MAX_VECTORS) that an exact scan beats the index.
+        """
+        index = self.vectorstore.index
+        if not 0 < index.ntotal <= BRUTE_FORCE_MAX_VECTORS:
+            return
+        # Scan the float32 vectors saved at ingestion: reconstructing them from the
+        # SQ8/PQ index would only return its lossy codes
+        vectors_path = os.path.join(FAISS_INDEX_PATH, FAISS_VECTORS_FILE)
+        if not os.path.exists(vectors_path):
+            print(f"{vectors_path} not found; re-run ingest_data.py to enable brute-force retrieval.")
+            return
+        matrix = np.load(vectors_path, mmap_mode="r")
+        if matrix.shape[0] != index.ntotal:
+            print(f"{vectors_path} does not match the FAISS index; re-run ingest_data.py to enable brute-force retrieval.")
+            return
+        # SimSIMD has native fp16 dot-product kernels, halving the bytes scanned per query;
+        # numpy has no fp16 BLAS path, so its fallback keeps float32
+        matrix_dtype = np.float16 if simsimd is not None else np.float32
+        split = min(BRUTE_FORCE_PRUNE_DIMS, matrix.shape[1])
+        self._doc_head = np.ascontiguousarray(matrix[:, :split], dtype=matrix_dtype)
+        self._doc_tail = np.ascontiguousarray(matrix[:, split:], dtype=matrix_dtype)
+        self._tail_norms = np.linalg.norm(matrix[:, split:], axis=1).astype(np.float32)
+        self._docs = [
+            self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[i])
+            for i in range(index.ntotal)
+        ]
+        backend = "SimSIMD" if simsimd is not None else "numpy"
+        print(f"Brute-force retrieval enabled over {index.ntotal} vectors ({backend}, {np.dtype(matrix_dtype).name}).")
+
+
+    @staticmethod
+    def _dot_rows(matrix, vec):
+        """
+        Inner product of vec with every row of matrix, as float32.
+        """
+        if matrix.shape[1] == 0:
+            return np.zeros(len(matrix), dtype=np.float32)
+        if simsimd is not None:
+            return np.asarray(simsimd.cdist(vec[None, :], matrix, metric="dot"), dtype=np.float32)[0]
+        return matrix @ vec
+
+
+    def _top1_with_threshold(self, query_vec, threshold: float):
+        """
+        Brute-force top-1 with early abort. Chunks are first scored on the leading dimensions only;
+        the trailing part can add at most |q_tail| * |x_tail| (Cauchy-Schwarz), so chunks whose
+        upper bound misses the threshold are dropped before their trailing dimensions are read.
+        Returns (row ids, scores) arrays holding the best chunk, or empty arrays if no chunk
+        can reach the threshold.
+        """
+        query_vec = np.asarray(query_vec, dtype=self._doc_head.dtype)
+        split = self._doc_head.shape[1]
+        query_tail = query_vec[split:]
+        partial = self._dot_rows(self._doc_head, query_vec[:split])
+        upper_bounds = partial + self._tail_norms * float(np.linalg.norm(query_tail.astype(np.float32)))
+        candidates = np.flatnonzero(upper_bounds >= threshold)
+        if len(candidates) == 0:
+            return candidates, partial[candidates]
+        scores = partial[candidates] + self._dot_rows(self._doc_tail[candidates], query_tail)
+        best = scores.argmax(keepdims=True)
+        return candidates[best], scores[best]
+
+
+    def _search_top1(self, query_vec):
+        """
+        Top-1 retrieval for an embedded query: brute-force when enabled, FAISS index otherwise.
+        Returns (ids, scores) arrays; FAISS pads a missing result with id -1. The brute-force path
+        prunes chunks that cannot reach RELEVANCE_THRESHOLD_IP, so it may return no result where
+        FAISS returns a low-scoring chunk.
+        """
+        if self._docs is not None:
+            return self._top1_with_threshold(query_vec, RELEVANCE_THRESHOLD_IP)
+        scores, ids = self.vectorstore.index.search(np.asarray(query_vec, dtype=np.float32).reshape(1, -1), 1)
+        return ids[0], scores[0]
+
+
+    def _doc_by_id(self, doc_id: int):
         """
-        Retrieves only the single most relevant document (k=1) and applies a relevance threshold.
-        Returns a list of (Document, score) tuples for relevant documents.
+        Looks up the Document stored at a FAISS id (row position).
+        """
+        if self._docs is not None:
+            return self._docs[doc_id]
+        return self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[doc_id])
+
+
+    def _embed_uncached(self, normalized_query: str):
+        """
+        Embeds a normalized query; wrapped by the per-instance LRU cache in __init__.
+        The vector is L2-unit-normalized here, once, so inner-product scores are cosine
+        similarities whatever the embedding backend returns.
+        """
+        query_vec = np.asarray(self.embeddings_model.embed_query(normalized_query), dtype=np.float32)
+        query_vec /= max(float(np.linalg.norm(query_vec)), 1e-12)
+        query_vec.flags.writeable = False  # Shared by every cache hit
+        return query_vec
+
+
+    def embed_query(self, query: str):
+        """
+        Embeds a query, reusing the vector of a recent identical query.
+        The cache key is case- and whitespace-normalized; the default MiniLM tokenizer
+        lowercases its input anyway, so this does not change the resulting embedding.
+        Returns:
+            np.ndarray: The unit-norm float32 query embedding (read-only).
+        """
+        if self.embeddings_model is None:
+            raise RuntimeError("Embeddings model is not initialized.")
+        return self._embed_normalized(query.strip().lower())
+
+
+    @staticmethod
+    def _unit_rows(vectors):
+        """
+        Returns vectors as a float32 matrix with every row L2-unit-normalized.
+        """
+        matrix = np.array(vectors, dtype=np.float32, ndmin=2)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        return matrix
+
+
+    def embed_queries(self, queries):
+        """
+        Embeds several queries in one batched call.
+        Returns:
+            np.ndarray: (len(queries), dim) float32 matrix of unit-norm query embeddings.
         """
         if self.embeddings_model is None:
             raise RuntimeError("Embeddings model is not initialized.")
-        query_embedding = self.embeddings_model.embed_query(query)
+        return self._unit_rows(self.embeddings_model.embed_documents(list(queries)))
+
+
+    def _retrieve(self, query: str):
+        """
+        Single retrieval path: embeds the query once (cached), searches the top chunk
+        and applies the relevance threshold.
+        Returns a list holding the (Document, score) tuple of the top chunk, or an empty
+        list if it is not relevant enough.
+        """
         if self.vectorstore is None:
             raise RuntimeError("Vectorstore is not initialized.")
-        results = self.vectorstore.similarity_search_by_vector(query_embedding, k=TOP_K_RETRIEVAL)
-        filtered_docs_with_scores = []
-        for result in results:
-            if isinstance(result, tuple) and len(result) == 2:
-                doc, score = result
-            else:
-                doc, score = result, 0.0
-            if isinstance(score, (float, int)) and score <= RELEVANCE_THRESHOLD_L2:
-                filtered_docs_with_scores.append((doc, score))
-            else:
-                src = getattr(doc, 'metadata', {}).get('source', 'N/A')
-                print(f"  Debug: Filtering out document due to low relevance score: {score} > {RELEVANCE_THRESHOLD_L2} (Source: {src})")
-        return filtered_docs_with_scores
+        query_embedding = self.embed_query(query)
+        ids, scores = self._search_top1(query_embedding)
+        # Threshold filter as one vectorized mask; Documents are only looked up for the survivors
+        found = ids >= 0
+        keep = found & (scores >= RELEVANCE_THRESHOLD_IP)
+        num_filtered = int(found.sum() - keep.sum())
+        if num_filtered:
+            print(f"  Debug: Filtering out {num_filtered} document(s) with relevance score < {RELEVANCE_THRESHOLD_IP}")
+        return [(self._doc_by_id(int(i)), float(score)) for i, score in zip(ids[keep], scores[keep])]
+
+
+    def _retrieve_top_doc(self, user_query: str):
+        """
+        Retrieves the single most relevant chunk for a query.
+        Returns the Document, or None if nothing passes the relevance threshold.
+        """
+        retrieved_docs_with_scores = self._retrieve(user_query)
+        if not retrieved_docs_with_scores:
+            print("No sufficiently relevant documents found. Returning canned response.")
+            return None
+        top_doc, top_score = retrieved_docs_with_scores[0]
+        print(f"[DEBUG] Top document score for query '{user_query}': {top_score}")
+        return top_doc
 
 
     def query(self, user_query: str):
@@ -112,46 +253,159 @@ class RAGPipeline:
             print(f"Processing query: '{user_query}'")
 
             # Step 1: Retrieve only the single most relevant chunk for context, with score
-            retrieved_docs_with_scores = self.vectorstore.similarity_search_with_score(user_query, k=1)
-            if not retrieved_docs_with_scores:
-                print("No sufficiently relevant documents found. Returning canned response.")
-                return ("I'm sorry, but I don't have enough information to answer that based on the provided knowledge base.", [])
-
-            top_doc, top_score = retrieved_docs_with_scores[0]
-            print(f"[DEBUG] Top document score for query '{user_query}': {top_score}")
-            import numbers
-            if not isinstance(top_score, numbers.Number):
-                print(f"Top document score is not a number. Returning fallback answer.")
-                return ("I'm sorry, but I don't have enough information to answer that based on the provided knowledge base.", [])
-            if float(top_score) > RELEVANCE_THRESHOLD_L2:
-                print(f"Top document score {top_score} exceeds threshold {RELEVANCE_THRESHOLD_L2}. Returning fallback answer.")
-                return ("I'm sorry, but I don't have enough information to answer that based on the provided knowledge base.", [])
+            top_doc = self._retrieve_top_doc(user_query)
+            if top_doc is None:
+                return (NO_INFO_ANSWER, [])
 
             context = getattr(top_doc, "page_content", str(top_doc))
-            minimal_prompt = PROMPT_TEMPLATE.format(context=context, question=user_query)
+            minimal_prompt = build_prompt(context, user_query)
 
             answer = self.llm.invoke(minimal_prompt)
-            # HuggingFacePipeline may return a list of dicts or a string
-            if isinstance(answer, list) and len(answer) > 0:
-                first = answer[0]
-                if isinstance(first, dict) and "generated_text" in first:
-                    generated = first.get("generated_text", "")
-                    answer_text = generated[len(minimal_prompt):].strip()
-                else:
-                    answer_text = str(first).strip()
-            else:
-                answer_text = str(answer).strip()
+            return (self._extract_answer(answer), [top_doc])
+        except Exception as e:
+            print(f"Error during query: {e}")
+            return (f"An error occurred during query: {e}", [])
+
+
+    async def aquery(self, user_query: str):
+        """
+        Async variant of query(). Retrieval runs in a worker thread and generation is awaited,
+        so concurrent callers can have several requests in flight at once (batched by the
+        vLLM scheduler when LLM_BACKEND = "vllm").
+        Returns the LLM's answer and source documents, or fallback if not relevant.
+        """
+        try:
+            if not (self.vectorstore and self.llm):
+                return ("RAG Pipeline components not initialized.", [])
 
-            for stop in ["\nQuestion:", "\nQ:", "\nUser:"]:
-                if stop in answer_text:
-                    answer_text = answer_text.split(stop)[0].strip()
+            print(f"Processing async query: '{user_query}'")
+            top_doc = await asyncio.to_thread(self._retrieve_top_doc, user_query)
+            if top_doc is None:
+                return (NO_INFO_ANSWER, [])
 
-            return (answer_text, [top_doc])
+            minimal_prompt = build_prompt(top_doc.page_content, user_query)
+            answer = await self.llm.ainvoke(minimal_prompt)
+            return (self._extract_answer(answer), [top_doc])
         except Exception as e:
             print(f"Error during query: {e}")
             return (f"An error occurred during query: {e}", [])
 
 
+    def stream_query(self, user_query: str):
+        """
+        Streaming variant of query(): yields (partial answer, source documents) tuples
+        as the LLM generates, ending with the complete answer.
+        """
+        try:
+            if not (self.vectorstore and self.llm):
+                yield ("RAG Pipeline components not initialized.", [])
+                return
+
+            print(f"Processing streaming query: '{user_query}'")
+            top_doc = self._retrieve_top_doc(user_query)
+            if top_doc is None:
+                yield (NO_INFO_ANSWER, [])
+                return
+
+            minimal_prompt = build_prompt(top_doc.page_content, user_query)
+            generated, answer = "", ""
+            for text_chunk in self.llm.stream(minimal_prompt):
+                generated += text_chunk
+                partial = self._extract_answer(generated)
+                # Whitespace-only chunks don't change the rendered answer, so skip the UI update
+                if partial != answer:
+                    answer = partial
+                    yield (answer, [top_doc])
+                if _STOP_RE.search(generated):
+                    break  # Stop consuming as soon as a stop sequence shows up
+            yield (answer, [top_doc])
+        except Exception as e:
+            print(f"Error during query: {e}")
+            yield (f"An error occurred during query: {e}", [])
+
+
+    def query_batch(self, user_queries, query_vecs=None):
+        """
+        Queries the RAG pipeline with several questions at once: one batched embedding call
+        for retrieval and one batched LLM call covering every question with a relevant chunk.
+        Args:
+            user_queries (list): List of user questions.
+            query_vecs (list, optional): Precomputed query embeddings, aligned with user_queries.
+        Returns:
+            Tuple[list, list]: (answers, source document lists), aligned with user_queries.
+        """
+        user_queries = list(user_queries)
+        try:
+            if not (self.vectorstore and self.llm):
+                return (["RAG Pipeline components not initialized."] * len(user_queries), [[] for _ in user_queries])
+
+            print(f"Processing batch of {len(user_queries)} queries...")
+            top_docs = self.retrieve_batch(user_queries, query_vecs)
+            return self.generate_batch(user_queries, top_docs)
+        except Exception as e:
+            print(f"Error during batch query: {e}")
+            return ([f"An error occurred during query: {e}"] * len(user_queries), [[] for _ in user_queries])
+
+
+    def retrieve_batch(self, user_queries, query_vecs=None):
+        """
+        Retrieval half of query_batch(): embeds all questions in one call and looks up the
+        top chunk for each. Questions whose best score misses the relevance threshold get None,
+        which generate_batch() answers with the canned refusal without touching the LLM.
+        Args:
+            user_queries (list): List of user questions.
+            query_vecs (list, optional): Precomputed query embeddings, aligned with user_queries.
+        Returns:
+            list: Top Document per question, or None if nothing is relevant enough.
+        """
+        if query_vecs is None:
+            query_vecs = self.embed_queries(user_queries)
+        else:
+            # Inner-product scores are only cosine similarities for unit-norm queries
+            query_vecs = self._unit_rows(query_vecs)
+        top_docs = []
+        for query_vec in query_vecs:
+            ids, scores = self._search_top1(query_vec)
+            if len(ids) == 0 or ids[0] < 0 or scores[0] < RELEVANCE_THRESHOLD_IP:
+                top_docs.append(None)
+            else:
+                top_docs.append(self._doc_by_id(int(ids[0])))
+        return top_docs
+
+
+    def generate_batch(self, user_queries, top_docs):
+        """
+        Generation half of query_batch(): one batched LLM call over the questions that have a
+        relevant chunk; the rest get NO_INFO_ANSWER directly.
+        Args:
+            user_queries (list): List of user questions.
+            top_docs (list): Output of retrieve_batch(), aligned with user_queries.
+        Returns:
+            Tuple[list, list]: (answers, source document lists), aligned with user_queries.
+        """
+        answers = [NO_INFO_ANSWER] * len(user_queries)
+        sources = [[] for _ in user_queries]
+        prompts, prompt_indices = [], []
+        for i, (user_query, top_doc) in enumerate(zip(user_queries, top_docs)):
+            if top_doc is None:
+                continue
+            prompts.append(build_prompt(top_doc.page_content, user_query))
+            prompt_indices.append(i)
+            sources[i] = [top_doc]
+
+        if prompts:
+            for i, prompt, answer in zip(prompt_indices, prompts, self.llm.batch(prompts)):
+                answers[i] = self._extract_answer(answer)
+        return (answers, sources)
+
+
+    def _extract_answer(self, answer: str) -> str:
+        """
+        Cuts the generated text (new tokens only, never the prompt) at the first stop sequence.
+        """
+        return _STOP_RE.split(answer, 1)[0].strip()
+
+
 # --- Debug CLI Entry Point (Optional) ---
 # if __name__ == "__main__":
 #     try: